@@ -1,9 +1,18 @@
 import streamlit as st
-import json
+import base64
+import bcrypt
+import fcntl
+import orjson
 import os
-import uuid
+import re
+import shutil
+import threading
+import time
+import zstandard as zstd
+from collections import OrderedDict
 from datetime import datetime
-import google.generativeai as genai
+from ulid import ULID
+import semantic_cache
 
 # Configure app
 st.set_page_config(page_title="AI Nutritionist", layout="wide")
@@ -20,18 +29,61 @@ if 'current_view' not in st.session_state:
 if 'current_plan' not in st.session_state:
     st.session_state.current_plan = None
 
-# File path for saving meal plans
-HISTORY_FILE = "meal_plan_history.json"
+# Directory for saving meal plans, one file per user
+HISTORY_DIR = "history"
+os.makedirs(HISTORY_DIR, exist_ok=True)
 
-# User credentials (in a real app, this should be securely stored)
+# Older single-file history stores (oldest first), split into per-user logs on startup
+LEGACY_HISTORY_FILE = "meal_plan_history.json"
+LEGACY_HISTORY_LOG = "meal_plan_history.jsonl"
+
+# User credentials as bcrypt hashes (in a real app, this should be securely stored)
 USERS = {
-    "Zach": "ZML",
-    "Mal": "MMM"
+    "Zach": b"$2b$12$q6xQwcPGfUs8j0TNaxn3e.2r94GG/V/rofzlFQB3ZLyjD8Hgg5EnC",
+    "Mal": b"$2b$12$pTGoLcomsa7M9g6P1uNfr.rDV/5AufqomF9e7aNBpOuZNSVNq6xkq"
 }
 
+# Checked against unknown usernames so failed logins take the same time
+DUMMY_HASH = b"$2b$12$nK7nToqqw8wLABIAUWFx3OLD2aobCDM5CX/KCz8Geqc8l4b2b4MJq"
+
+# Lifetime and size limit of the exact-match meal plan cache
+PLAN_CACHE_TTL = 24*60*60
+PLAN_CACHE_MAX_ENTRIES = 256
+
 # Configure Gemini API using environment variables (for Heroku)
 API_KEY = os.getenv("GEMINI_API_KEY", None)
 
+# Invariant part of the meal plan prompt, sent as the system instruction so it
+# forms a stable prefix Gemini can cache across requests
+SYSTEM_PREFIX = """
+Act as a professional nutritionist. Create a personalized meal plan using the dietary restrictions and additional information provided by the user.
+
+Please provide a structured meal plan that includes:
+1. Breakfast options (3 suggestions)
+2. Lunch options (3 suggestions)
+3. Dinner options (3 suggestions)
+4. Snack options (3 suggestions)
+5. Nutritional insights about this plan
+6. Customized recommendations based on the provided information
+
+Format the response in markdown.
+"""
+
+# Per-request part of the meal plan prompt
+PROMPT_TEMPLATE = """
+Dietary Restrictions: {constraints_text}
+Additional Information: {additional_info}
+"""
+
+# Configure Gemini and build the model once per process (imported lazily, since
+# the client libraries are slow to load and only needed to generate plans)
+@st.cache_resource(show_spinner=False)
+def get_model():
+    import google.generativeai as genai
+    
+    genai.configure(api_key=API_KEY)
+    return genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_PREFIX)
+
 # Function to configure Gemini
 def configure_gemini():
     if not API_KEY:
@@ -39,75 +91,224 @@ def configure_gemini():
         return False
     
     try:
-        genai.configure(api_key=API_KEY)
+        get_model()
         return True
     except Exception as e:
         st.error(f"Error configuring Gemini API: {str(e)}")
         return False
 
-# Load existing history
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r') as f:
-                history = json.load(f)
-                return history
-        except Exception as e:
-            st.error(f"Error loading history: {str(e)}")
-    return {}
+# Path of a user's history log (append-only, one JSON record per line)
+def history_path(username):
+    return os.path.join(HISTORY_DIR, f"{username}.jsonl")
 
-# Save history
-def save_history(history):
+# Parse a user's history log, cached until the file changes on disk
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _load_history_cached(path, mtime_ns, size):
+    history = {}
     try:
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=4)
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                # Skip a corrupt record rather than dropping everything after it
+                try:
+                    record = orjson.loads(line)
+                    plan_id = record.pop("plan_id")
+                except (orjson.JSONDecodeError, KeyError):
+                    continue
+                history[plan_id] = record
+    except Exception as e:
+        st.error(f"Error loading history: {str(e)}")
+    return history
+
+# Load a user's existing history
+def load_history(username):
+    path = history_path(username)
+    if not os.path.exists(path):
+        return {}
+    stat = os.stat(path)
+    return _load_history_cached(path, stat.st_mtime_ns, stat.st_size)
+
+# Append a single meal plan record to a user's history log
+def save_history(username, record):
+    try:
+        with open(history_path(username), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
     except Exception as e:
         st.error(f"Error saving history: {str(e)}")
 
+# Read the legacy nested {user: {plan_id: plan}} history into per-user records
+def _read_legacy_history(path):
+    with open(path, 'rb') as f:
+        history = orjson.loads(f.read())
+    return {
+        username: [{"plan_id": plan_id, **plan_info} for plan_id, plan_info in plans.items()]
+        for username, plans in history.items()
+    }
+
+# Read the legacy shared history log (one record per line, keyed by "user")
+def _read_legacy_history_log(path):
+    records_by_user = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = orjson.loads(line)
+                username = record.pop("user")
+            except (orjson.JSONDecodeError, KeyError):
+                continue
+            records_by_user.setdefault(username, []).append(record)
+    return records_by_user
+
+# Write records ahead of anything already in a user's history log
+def _prepend_history(username, records):
+    path = history_path(username)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as out:
+        for record in records:
+            out.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+    os.replace(tmp_path, path)
+
+# Move plans from the legacy history files into per-user logs (once per process)
+@st.cache_resource(show_spinner=False)
+def migrate_legacy_history():
+    legacy_readers = [
+        (LEGACY_HISTORY_FILE, _read_legacy_history),
+        (LEGACY_HISTORY_LOG, _read_legacy_history_log)
+    ]
+    legacy_paths = [path for path, _ in legacy_readers if os.path.exists(path)]
+    if not legacy_paths:
+        return
+    
+    try:
+        records_by_user = {}
+        for path, read in legacy_readers:
+            if path in legacy_paths:
+                for username, records in read(path).items():
+                    records_by_user.setdefault(username, []).extend(records)
+        
+        for username, records in records_by_user.items():
+            _prepend_history(username, records)
+        for path in legacy_paths:
+            os.replace(path, path + ".migrated")
+    except Exception as e:
+        st.error(f"Error migrating history: {str(e)}")
+
+migrate_legacy_history()
+
+# Normalize free-text input so trivially different requests share a cache entry
+def normalize_additional_info(additional_info):
+    return re.sub(r"\s+", " ", additional_info.strip().lower())
+
+# Exact-match cache of generated plans, shared across sessions
+@st.cache_resource(show_spinner=False)
+def _get_plan_cache():
+    return {"plans": OrderedDict(), "lock": threading.Lock()}
+
+# Return a cached plan for identical normalized inputs, if it hasn't expired
+def get_cached_meal_plan(cache_key):
+    cache = _get_plan_cache()
+    with cache["lock"]:
+        entry = cache["plans"].get(cache_key)
+        if entry is None:
+            return None
+        expires_at, meal_plan = entry
+        if expires_at < time.time():
+            del cache["plans"][cache_key]
+            return None
+        cache["plans"].move_to_end(cache_key)
+        return meal_plan
+
+# Store a plan, evicting the least recently used entries past the size limit
+def cache_meal_plan(cache_key, meal_plan):
+    cache = _get_plan_cache()
+    with cache["lock"]:
+        cache["plans"][cache_key] = (time.time() + PLAN_CACHE_TTL, meal_plan)
+        cache["plans"].move_to_end(cache_key)
+        while len(cache["plans"]) > PLAN_CACHE_MAX_ENTRIES:
+            cache["plans"].popitem(last=False)
+
+# Stream a meal plan from Gemini, showing it in the placeholder as it arrives
+def stream_meal_plan(gluten_free, dairy_free, additional_info, placeholder=None):
+    dietary_constraints = []
+    if gluten_free:
+        dietary_constraints.append("gluten-free")
+    if dairy_free:
+        dietary_constraints.append("dairy-free")
+    
+    constraints_text = ", ".join(dietary_constraints) if dietary_constraints else "No specific dietary restrictions"
+    
+    prompt = PROMPT_TEMPLATE.format(constraints_text=constraints_text, additional_info=additional_info)
+    
+    chunks = []
+    for chunk in get_model().generate_content(prompt, stream=True):
+        chunks.append(chunk.text)
+        if placeholder is not None:
+            placeholder.markdown("".join(chunks))
+    return "".join(chunks)
+
 # Function to generate meal plan
-def generate_meal_plan(gluten_free, dairy_free, additional_info):
+def generate_meal_plan(gluten_free, dairy_free, additional_info, placeholder=None):
+    gluten_free = bool(gluten_free)
+    dairy_free = bool(dairy_free)
+    additional_info = normalize_additional_info(additional_info)
+    
+    cache_key = (gluten_free, dairy_free, additional_info)
+    meal_plan = get_cached_meal_plan(cache_key)
+    if meal_plan is not None:
+        return meal_plan
+
     if not configure_gemini():
         return "Error: Unable to configure Gemini API"
 
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        dietary_constraints = []
-        if gluten_free:
-            dietary_constraints.append("gluten-free")
-        if dairy_free:
-            dietary_constraints.append("dairy-free")
-        
-        constraints_text = ", ".join(dietary_constraints) if dietary_constraints else "No specific dietary restrictions"
-        
-        prompt = f"""
-        Act as a professional nutritionist. Create a personalized meal plan with the following considerations:
-        
-        Dietary Restrictions: {constraints_text}
-        Additional Information: {additional_info}
-        
-        Please provide a structured meal plan that includes:
-        1. Breakfast options (3 suggestions)
-        2. Lunch options (3 suggestions)
-        3. Dinner options (3 suggestions)
-        4. Snack options (3 suggestions)
-        5. Nutritional insights about this plan
-        6. Customized recommendations based on the provided information
-        
-        Format the response in markdown.
-        """
+    # Reuse a plan generated for a paraphrase of the same request. The semantic
+    # cache is best-effort, so any failure in it falls through to Gemini
+    embedding = None
+    if semantic_cache.ENABLED:
+        try:
+            embedding = semantic_cache.embed(additional_info)
+            meal_plan = semantic_cache.lookup((gluten_free, dairy_free), embedding)
+        except Exception:
+            embedding = None
+    
+    if meal_plan is None:
+        try:
+            meal_plan = stream_meal_plan(gluten_free, dairy_free, additional_info, placeholder)
+        except Exception as e:
+            return f"Error generating meal plan: {str(e)}"
         
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        return f"Error generating meal plan: {str(e)}"
+        if embedding is not None:
+            try:
+                semantic_cache.add((gluten_free, dairy_free), embedding, meal_plan)
+            except Exception:
+                pass
+    
+    cache_meal_plan(cache_key, meal_plan)
+    return meal_plan
 
 # Login function
 def login(username, password):
-    if username in USERS and USERS[username] == password:
+    password_hash = USERS.get(username, DUMMY_HASH)
+    try:
+        password_ok = bcrypt.checkpw(password.encode(), password_hash)
+    except ValueError:
+        password_ok = False
+    
+    if username in USERS and password_ok:
         st.session_state.authenticated = True
         st.session_state.username = username
         st.session_state.current_view = "meal_planner"
-        st.session_state.history = load_history()
+        # Copy so saves in this session don't touch the dict shared by the cache
+        st.session_state.history = dict(load_history(username))
         return True
     return False
 
@@ -115,23 +316,49 @@ def login(username, password):
 def logout():
     st.session_state.authenticated = False
     st.session_state.username = None
+    st.session_state.history = {}
     st.session_state.current_view = "login"
 
+# Compress meal plan markdown for storage
+def compress_meal_plan(meal_plan):
+    compressed = zstd.ZstdCompressor(level=10).compress(meal_plan.encode())
+    return base64.b64encode(compressed).decode()
+
+# Return a plan's markdown, decompressing it if needed (older records are plaintext)
+def get_meal_plan_text(plan_info):
+    if "meal_plan_zstd_b64" in plan_info:
+        compressed = base64.b64decode(plan_info["meal_plan_zstd_b64"])
+        return zstd.ZstdDecompressor().decompress(compressed).decode()
+    return plan_info.get("meal_plan", "")
+
+# Display text for a plan's preferences, stored with the plan when it is saved
+def summarize_preferences(preferences):
+    dietary_restrictions = []
+    if preferences.get("gluten_free"):
+        dietary_restrictions.append("Gluten-Free")
+    if preferences.get("dairy_free"):
+        dietary_restrictions.append("Dairy-Free")
+    
+    additional_info = preferences.get("additional_info", "")
+    
+    return {
+        "restrictions_text": ", ".join(dietary_restrictions) if dietary_restrictions else "None",
+        "info_preview": additional_info[:30] + "..." if len(additional_info) > 30 else additional_info
+    }
+
 # Save meal plan
 def save_meal_plan(meal_plan, preferences):
-    if st.session_state.username not in st.session_state.history:
-        st.session_state.history[st.session_state.username] = {}
+    plan_id = str(ULID())
     
-    plan_id = str(uuid.uuid4())
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    st.session_state.history[st.session_state.username][plan_id] = {
-        "timestamp": timestamp,
+    plan_info = {
+        "ts": time.time(),
         "preferences": preferences,
-        "meal_plan": meal_plan
+        "meal_plan_zstd_b64": compress_meal_plan(meal_plan)
     }
+    plan_info.update(summarize_preferences(preferences))
+    st.session_state.history[plan_id] = plan_info
     
-    save_history(st.session_state.history)
+    save_history(st.session_state.username, {"plan_id": plan_id, **plan_info})
     return plan_id
 
 # App layout and routing
@@ -155,12 +382,9 @@ def main():
     # Routing based on current view
     if not st.session_state.authenticated:
         render_login_page()
-    elif st.session_state.current_view == "meal_planner":
-        render_meal_planner()
-    elif st.session_state.current_view == "history":
-        render_history_page()
-    elif st.session_state.current_view == "view_plan":
-        render_view_plan()
+        return
+    
+    VIEWS.get(st.session_state.current_view, render_meal_planner)()
 
 # Login page
 def render_login_page():
@@ -209,7 +433,9 @@ def render_meal_planner():
                 "additional_info": additional_info
             }
             
-            meal_plan = generate_meal_plan(gluten_free, dairy_free, additional_info)
+            placeholder = st.empty()
+            meal_plan = generate_meal_plan(gluten_free, dairy_free, additional_info, placeholder)
+            placeholder.empty()
             st.session_state.current_plan = {
                 "meal_plan": meal_plan,
                 "preferences": preferences
@@ -217,72 +443,87 @@ def render_meal_planner():
     
     # Display current meal plan if it exists
     if st.session_state.current_plan:
-        st.markdown(st.session_state.current_plan["meal_plan"])
+        st.markdown(get_meal_plan_text(st.session_state.current_plan))
         
         if st.button("Save This Meal Plan"):
             plan_id = save_meal_plan(
-                st.session_state.current_plan["meal_plan"],
+                get_meal_plan_text(st.session_state.current_plan),
                 st.session_state.current_plan["preferences"]
             )
             st.success(f"Meal plan saved successfully! ID: {plan_id}")
 
+# Keep free text from breaking out of a Markdown table cell
+def escape_table_cell(text):
+    return " ".join(text.split()).replace("\\", "\\\\").replace("|", "\\|")
+
+# Build the history table rows, reused across reruns until the plan IDs change.
+# The records are only read here, since this body runs only on cache misses
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_history_rows(plan_ids, _user_history):
+    history_data = []
+    for plan_id in plan_ids:
+        plan_info = _user_history[plan_id]
+        
+        # Older records were saved before the display text was precomputed
+        summary = plan_info
+        if "restrictions_text" not in plan_info or "info_preview" not in plan_info:
+            summary = summarize_preferences(plan_info.get("preferences", {}))
+        
+        # Newer records store the save time as a float; older ones preformatted it
+        if "ts" in plan_info:
+            date_text = datetime.fromtimestamp(plan_info["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            date_text = plan_info.get("timestamp", "Unknown")
+        
+        history_data.append({
+            "ID": plan_id,
+            "Date": date_text,
+            "Dietary Restrictions": summary["restrictions_text"],
+            "Additional Info": summary["info_preview"]
+        })
+    return history_data
+
 # History page
 def render_history_page():
     st.header("Your Meal Plan History")
     
-    if st.session_state.username not in st.session_state.history or not st.session_state.history[st.session_state.username]:
+    if not st.session_state.history:
         st.info("You haven't saved any meal plans yet.")
         return
     
-    user_history = st.session_state.history[st.session_state.username]
+    user_history = st.session_state.history
+    history_data = build_history_rows(tuple(user_history.keys()), user_history)
+    rows_by_id = {item["ID"]: item for item in history_data}
     
-    # Show history as a table
-    history_data = []
-    for plan_id, plan_info in user_history.items():
-        timestamp = plan_info.get("timestamp", "Unknown")
-        preferences = plan_info.get("preferences", {})
-        
-        dietary_restrictions = []
-        if preferences.get("gluten_free"):
-            dietary_restrictions.append("Gluten-Free")
-        if preferences.get("dairy_free"):
-            dietary_restrictions.append("Dairy-Free")
-        
-        restrictions_text = ", ".join(dietary_restrictions) if dietary_restrictions else "None"
-        additional_info = preferences.get("additional_info", "")
-        
-        history_data.append({
-            "ID": plan_id,
-            "Date": timestamp,
-            "Dietary Restrictions": restrictions_text,
-            "Additional Info": additional_info[:30] + "..." if len(additional_info) > 30 else additional_info
-        })
+    # Show history as a single Markdown table
+    table_rows = [
+        f"| {escape_table_cell(item['Date'])} | {escape_table_cell(item['Dietary Restrictions'])} | {escape_table_cell(item['Additional Info'])} |"
+        for item in history_data
+    ]
+    st.markdown("| Date | Restrictions | Notes |\n|---|---|---|\n" + "\n".join(table_rows))
     
-    # Custom history item display using columns
-    for item in history_data:
-        col1, col2, col3 = st.columns([1, 2, 1])
-        
-        with col1:
-            st.write(f"**Date:** {item['Date']}")
-        
-        with col2:
-            st.write(f"**Restrictions:** {item['Dietary Restrictions']}")
-            st.write(f"**Notes:** {item['Additional Info']}")
-            
-        with col3:
-            if st.button("View", key=f"view_{item['ID']}"):
-                st.session_state.current_plan = user_history[item['ID']]
-                st.session_state.current_view = "view_plan"
-                st.rerun()
-        
-        st.divider()
+    render_plan_selector(user_history, rows_by_id)
+
+# Plan selector, rerun on its own so changing the selection doesn't rerun the whole app
+@st.fragment
+def render_plan_selector(user_history, rows_by_id):
+    selected_id = st.selectbox(
+        "View plan",
+        options=list(rows_by_id),
+        format_func=lambda plan_id: f"{rows_by_id[plan_id]['Date']} - {rows_by_id[plan_id]['Dietary Restrictions']}"
+    )
+    
+    if st.button("View"):
+        st.session_state.current_plan = user_history[selected_id]
+        st.session_state.current_view = "view_plan"
+        st.rerun()
 
 # View plan page
 def render_view_plan():
     st.header("Saved Meal Plan")
     
     if st.session_state.current_plan:
-        st.markdown(st.session_state.current_plan["meal_plan"])
+        st.markdown(get_meal_plan_text(st.session_state.current_plan))
         
         if st.button("Back to History"):
             st.session_state.current_view = "history"
@@ -293,6 +534,13 @@ def render_view_plan():
             st.session_state.current_view = "history"
             st.rerun()
 
+# Page renderers for authenticated views
+VIEWS = {
+    "meal_planner": render_meal_planner,
+    "history": render_history_page,
+    "view_plan": render_view_plan
+}
+
 # Run the app
 if __name__ == "__main__":
     main()
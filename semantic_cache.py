@@ -0,0 +1,159 @@
+import importlib.util
+import json
+import os
+import threading
+from collections import deque
+import numpy as np
+import streamlit as st
+
+# File path for persisting cached responses and their embeddings
+SEMANTIC_CACHE_FILE = "semantic_cache.jsonl"
+
+# Small local embedding model and the cosine similarity needed for a hit
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SIMILARITY_THRESHOLD = 0.92
+
+# Most responses kept for each (gluten_free, dairy_free) partition
+MAX_ENTRIES_PER_PARTITION = 1000
+
+# sentence-transformers pulls in torch, which is too large for a basic Heroku
+# dyno, so it is an optional dependency and the cache is off without it
+ENABLED = importlib.util.find_spec("sentence_transformers") is not None
+
+_lock = threading.Lock()
+
+# Load the embedding model once per process (imported lazily to keep app startup fast)
+@st.cache_resource(show_spinner=False)
+def get_embedding_model():
+    from sentence_transformers import SentenceTransformer
+    
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+# Load persisted entries, partitioned by (gluten_free, dairy_free), along with
+# the number of entries currently written to disk
+@st.cache_resource(show_spinner=False)
+def _load_partitions():
+    entries = {}
+    entry_count = 0
+    if os.path.exists(SEMANTIC_CACHE_FILE):
+        try:
+            with open(SEMANTIC_CACHE_FILE, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        key = tuple(entry["key"])
+                        embedding = np.asarray(entry["embedding"], dtype=np.float32)
+                        response = entry["response"]
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    # Only the newest entries of each partition are kept
+                    entries.setdefault(key, deque(maxlen=MAX_ENTRIES_PER_PARTITION)).append((embedding, response))
+                    entry_count += 1
+        except Exception as e:
+            st.error(f"Error loading semantic cache: {str(e)}")
+    
+    partitions = {}
+    for key, items in entries.items():
+        for embedding, response in items:
+            _append(partitions, key, embedding, response)
+    
+    # Drop entries evicted while loading; add() compacts again as the file grows
+    kept_count = sum(len(items) for items in entries.values())
+    if entry_count > kept_count and _rewrite(entries):
+        entry_count = kept_count
+    return {"partitions": partitions, "disk_entries": entry_count}
+
+# Rewrite the cache file with only the entries still held in memory
+def _rewrite(entries):
+    tmp_path = SEMANTIC_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            for key, items in entries.items():
+                for embedding, response in items:
+                    f.write(json.dumps({
+                        "key": list(key),
+                        "embedding": embedding.tolist(),
+                        "response": response
+                    }) + "\n")
+        os.replace(tmp_path, SEMANTIC_CACHE_FILE)
+        return True
+    except Exception as e:
+        st.error(f"Error compacting semantic cache: {str(e)}")
+        return False
+
+# A partition's entries, oldest first
+def _partition_items(partition):
+    count = len(partition["responses"])
+    order = list(range(partition["oldest"], count)) + list(range(partition["oldest"]))
+    return [(partition["embeddings"][i], partition["responses"][i]) for i in order]
+
+# Add an entry to a partition. Embeddings live in a preallocated matrix that
+# doubles as needed; once full, the oldest entry is overwritten
+def _append(partitions, key, embedding, response):
+    partition = partitions.setdefault(key, {
+        "embeddings": np.empty((0, embedding.shape[0]), dtype=np.float32),
+        "responses": [],
+        "oldest": 0
+    })
+    count = len(partition["responses"])
+    
+    if count >= MAX_ENTRIES_PER_PARTITION:
+        index = partition["oldest"]
+        partition["embeddings"][index] = embedding
+        partition["responses"][index] = response
+        partition["oldest"] = (index + 1) % MAX_ENTRIES_PER_PARTITION
+        return
+    
+    if count == partition["embeddings"].shape[0]:
+        capacity = min(max(2 * count, 16), MAX_ENTRIES_PER_PARTITION)
+        embeddings = np.empty((capacity, embedding.shape[0]), dtype=np.float32)
+        embeddings[:count] = partition["embeddings"][:count]
+        partition["embeddings"] = embeddings
+    
+    partition["embeddings"][count] = embedding
+    partition["responses"].append(response)
+
+# Embed text as a unit-normalized vector
+def embed(text):
+    embedding = get_embedding_model().encode(text, normalize_embeddings=True)
+    return np.asarray(embedding, dtype=np.float32)
+
+# Return a cached response for a similar prompt with the same flags, if any
+def lookup(key, embedding):
+    partitions = _load_partitions()["partitions"]
+    with _lock:
+        partition = partitions.get(key)
+        if partition is None:
+            return None
+        
+        count = len(partition["responses"])
+        similarities = np.dot(partition["embeddings"][:count], embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= SIMILARITY_THRESHOLD:
+            return partition["responses"][best]
+        return None
+
+# Store a new response in memory and append it to disk, compacting the file
+# once it holds about twice as many entries as are kept in memory
+def add(key, embedding, response):
+    cache = _load_partitions()
+    partitions = cache["partitions"]
+    with _lock:
+        _append(partitions, key, embedding, response)
+        try:
+            with open(SEMANTIC_CACHE_FILE, 'a') as f:
+                f.write(json.dumps({
+                    "key": list(key),
+                    "embedding": embedding.tolist(),
+                    "response": response
+                }) + "\n")
+            cache["disk_entries"] += 1
+        except Exception as e:
+            st.error(f"Error saving semantic cache: {str(e)}")
+        
+        if cache["disk_entries"] > 2 * MAX_ENTRIES_PER_PARTITION * len(partitions):
+            entries = {partition_key: _partition_items(partition) for partition_key, partition in partitions.items()}
+            if _rewrite(entries):
+                cache["disk_entries"] = sum(len(items) for items in entries.values())